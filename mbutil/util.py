@@ -9,16 +9,58 @@
 # for additional reference on schema see:
 # https://github.com/mapbox/node-mbtiles/blob/master/lib/schema.sql
 
-import sqlite3, sys, logging, time, os, json, zlib, re, urllib3, concurrent.futures, threading
-from hashlib import sha1
+import sqlite3, sys, logging, time, os, shutil, json, zlib, re, asyncio, aiohttp, concurrent.futures, contextlib, itertools, collections, multiprocessing
+from hashlib import sha1, blake2b
 from pmtiles.reader import all_tiles, MmapSource, Reader
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 logger = logging.getLogger(__name__)
 
+# number of rows buffered before they are flushed with executemany
+BATCH_SIZE = 5000
+
+# number of rows fetched per round trip when exporting
+FETCH_SIZE = 1000
+
+# size of the chunks tiles are copied in when streamed to disk
+BLOB_CHUNK_SIZE = 65536
+
+# number of threads reading tile files during an import
+READ_WORKERS = 16
+
+# matches a JSONP callback wrapped around a UTFGrid
+CALLBACK_RE = re.compile(r'[\w\s=+-/]+\(({(.|\n)*})\);?')
+
+def json_dumps(obj):
+    return json.dumps(obj, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+def grid_dumps(grid, data):
+    # grid is the compressed grid blob, data its (key_name, key_json) pairs.
+    # orjson is optional and only speeds this up: it rejects NaN, Infinity
+    # and integers beyond 64 bits, so those grids go through the stdlib
+    if orjson:
+        try:
+            grid_json = orjson.loads(zlib.decompress(grid))
+            grid_json['data'] = {k: orjson.loads(v) for k, v in data}
+            return orjson.dumps(grid_json)
+        except (orjson.JSONDecodeError, orjson.JSONEncodeError):
+            pass
+    grid_json = json.loads(zlib.decompress(grid))
+    grid_json['data'] = {k: json.loads(v) for k, v in data}
+    return json_dumps(grid_json)
+
 def flip_y(zoom, y):
     return (2**zoom-1) - y
 
 def mbtiles_setup(cur):
+    mbtiles_setup_tables(cur)
+    mbtiles_setup_indexes(cur)
+
+def mbtiles_setup_tables(cur):
     cur.execute("""
         create table tiles (
             zoom_level integer,
@@ -32,6 +74,10 @@ def mbtiles_setup(cur):
     tile_row integer, grid blob);""")
     cur.execute("""CREATE TABLE grid_data (zoom_level integer, tile_column
     integer, tile_row integer, key_name text, key_json text);""")
+
+def mbtiles_setup_indexes(cur):
+    # created once the tables are filled, which is much cheaper than
+    # maintaining the b-trees row by row during a bulk import
     cur.execute("""create unique index name on metadata (name);""")
     cur.execute("""create unique index tile_index on tiles
         (zoom_level, tile_column, tile_row);""")
@@ -46,10 +92,21 @@ def mbtiles_connect(mbtiles_file, silent):
             logger.exception(e)
         sys.exit(1)
 
-def optimize_connection(cur):
-    cur.execute("""PRAGMA synchronous=0""")
-    cur.execute("""PRAGMA locking_mode=EXCLUSIVE""")
-    cur.execute("""PRAGMA journal_mode=DELETE""")
+def optimize_connection(cur, bulk=True):
+    if bulk:
+        # page_size only applies if set before the first table is created
+        cur.execute("""PRAGMA page_size=65536""")
+        cur.execute("""PRAGMA synchronous=0""")
+        cur.execute("""PRAGMA locking_mode=EXCLUSIVE""")
+        cur.execute("""PRAGMA journal_mode=OFF""")
+        cur.execute("""PRAGMA temp_store=MEMORY""")
+        cur.execute("""PRAGMA cache_size=-262144""")
+        cur.execute("""PRAGMA mmap_size=1073741824""")
+    else:
+        # restore safe settings before handing the file over
+        cur.execute("""PRAGMA locking_mode=NORMAL""")
+        cur.execute("""PRAGMA synchronous=NORMAL""")
+        cur.execute("""PRAGMA journal_mode=DELETE""")
 
 def compression_prepare(cur, silent):
     if not silent: 
@@ -81,6 +138,33 @@ def optimize_database(cur, silent):
     cur.isolation_level = ''  # reset default value of isolation_level
 
 
+IMAGES_INSERT = """insert into images
+    (tile_id, tile_data)
+    values (?, ?)"""
+
+MAP_INSERT = """insert into map
+    (zoom_level, tile_column, tile_row, tile_id)
+    values (?, ?, ?, ?)"""
+
+def compression_insert(cur, images, tile_map, silent):
+    start = time.time()
+    cur.executemany(IMAGES_INSERT, images)
+    if not silent:
+        logger.debug("insert into images: %s" % (time.time() - start))
+    start = time.time()
+    cur.executemany(MAP_INSERT, tile_map)
+    if not silent:
+        logger.debug("insert into map: %s" % (time.time() - start))
+    del images[:]
+    del tile_map[:]
+
+def tile_digest(tile_data):
+    # a 12 byte digest keeps the map small, collisions stay negligible
+    return blake2b(tile_data, digest_size=12).digest()
+
+def tile_digests(rows):
+    return [tile_digest(r[3]) for r in rows]
+
 def compression_do(cur, con, chunk, silent):
     if not silent:
         logger.debug('Making database compression.')
@@ -93,50 +177,43 @@ def compression_do(cur, con, chunk, silent):
     last_id = 0
     if not silent:
         logging.debug("%d total tiles to fetch" % total_tiles)
-    for i in range(total_tiles // chunk + 1):
-        if not silent:
-            logging.debug("%d / %d rounds done" % (i, (total_tiles / chunk)))
-        ids = []
-        files = []
-        start = time.time()
-        cur.execute("""select zoom_level, tile_column, tile_row, tile_data
-            from tiles where rowid > ? and rowid <= ?""", ((i * chunk), ((i + 1) * chunk)))
-        if not silent:
-            logger.debug("select: %s" % (time.time() - start))
-        rows = cur.fetchall()
-        for r in rows:
-            total = total + 1
-            if r[3] in files:
-                overlapping = overlapping + 1
-                start = time.time()
-                query = """insert into map
-                    (zoom_level, tile_column, tile_row, tile_id)
-                    values (?, ?, ?, ?)"""
-                if not silent:
-                    logger.debug("insert: %s" % (time.time() - start))
-                cur.execute(query, (r[0], r[1], r[2], ids[files.index(r[3])]))
-            else:
-                unique = unique + 1
-                last_id += 1
-
-                ids.append(last_id)
-                files.append(r[3])
-
-                start = time.time()
-                query = """insert into images
-                    (tile_id, tile_data)
-                    values (?, ?)"""
-                cur.execute(query, (str(last_id), sqlite3.Binary(r[3])))
-                if not silent:
-                    logger.debug("insert into images: %s" % (time.time() - start))
-                start = time.time()
-                query = """insert into map
-                    (zoom_level, tile_column, tile_row, tile_id)
-                    values (?, ?, ?, ?)"""
-                cur.execute(query, (r[0], r[1], r[2], last_id))
+    seen = {}
+    images = []
+    tile_map = []
+    read_cur = con.cursor()
+    read_cur.execute("""select zoom_level, tile_column, tile_row, tile_data
+        from tiles""")
+    # each worker hashes a whole chunk ahead of the one being inserted
+    workers = os.cpu_count() or 1
+    pending = collections.deque()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        while True:
+            while len(pending) < workers:
+                next_rows = read_cur.fetchmany(chunk)
+                if not next_rows:
+                    break
+                pending.append((next_rows, executor.submit(tile_digests, next_rows)))
+            if not pending:
+                break
+            rows, digests = pending.popleft()
+            for r, h in zip(rows, digests.result()):
+                total = total + 1
+                tile_id = seen.get(h)
+                if tile_id is not None:
+                    overlapping = overlapping + 1
+                else:
+                    unique = unique + 1
+                    last_id += 1
+                    tile_id = last_id
+                    seen[h] = tile_id
+                    images.append((str(tile_id), sqlite3.Binary(r[3])))
+                tile_map.append((r[0], r[1], r[2], tile_id))
+            if len(tile_map) >= BATCH_SIZE:
+                compression_insert(cur, images, tile_map, silent)
                 if not silent:
-                    logger.debug("insert into map: %s" % (time.time() - start))
-        con.commit()
+                    logging.debug("%d / %d tiles done" % (total, total_tiles))
+    compression_insert(cur, images, tile_map, silent)
+    con.commit()
 
 def compression_finalize(cur, con, silent):
     if not silent:
@@ -163,9 +240,104 @@ def compression_finalize(cur, con, silent):
 
     cur.execute("""analyze;""")
 
+def insert_batch(cur, tiles, grids, grid_data):
+    cur.executemany("""insert into tiles (zoom_level,
+        tile_column, tile_row, tile_data) values
+        (?, ?, ?, ?);""", tiles)
+    cur.executemany("""insert into grids (zoom_level, tile_column, tile_row, grid) values (?, ?, ?, ?) """, grids)
+    cur.executemany("""insert into grid_data (zoom_level, tile_column, tile_row, key_name, key_json) values (?, ?, ?, ?, ?);""", grid_data)
+    del tiles[:]
+    del grids[:]
+    del grid_data[:]
+
 def get_dirs(path):
-    return [name for name in os.listdir(path)
-        if os.path.isdir(os.path.join(path, name))]
+    with os.scandir(path) as entries:
+        return [entry.name for entry in entries if entry.is_dir()]
+
+def read_file(path):
+    # unbuffered: the whole file is read at once, sized from fstat
+    with open(path, 'rb', buffering=0) as f:
+        return f.read()
+
+def encode_grid(file_content):
+    # Remove potential callback with regex
+    file_content = file_content.decode('utf-8')
+    has_callback = CALLBACK_RE.match(file_content)
+    if has_callback:
+        file_content = has_callback.group(1)
+    utfgrid = json.loads(file_content)
+
+    data = utfgrid.pop('data')
+    compressed = zlib.compress(json.dumps(utfgrid).encode())
+    grid_keys = [k for k in utfgrid['keys'] if k != ""]
+    return compressed, [(key_name, json.dumps(data[key_name])) for key_name in grid_keys]
+
+def grid_pool():
+    # spawn and forkserver workers re-run the caller's __main__, so only
+    # fork is safe for library callers; without it grids are encoded in-process
+    if 'fork' not in multiprocessing.get_all_start_methods():
+        return None
+    pool = concurrent.futures.ProcessPoolExecutor(
+        mp_context=multiprocessing.get_context('fork'))
+    # a fork pool starts all of its workers on the first submit, so they are
+    # forked now rather than while other threads hold locks
+    pool.submit(int).result()
+    return pool
+
+# x, y of a tile from its row directory and file name, per tiling scheme
+def tms_coords(z, row_dir, file_name):
+    return int(row_dir), int(file_name)
+
+def xyz_coords(z, row_dir, file_name):
+    return int(row_dir), flip_y(z, int(file_name))
+
+def zyx_coords(z, row_dir, file_name):
+    return int(file_name), flip_y(z, int(row_dir))
+
+def ags_coords(z, row_dir, file_name):
+    return int(file_name.replace("C", ""), 16), flip_y(z, int(row_dir.replace("R", ""), 16))
+
+def gwc_coords(z, row_dir, file_name):
+    x, y = file_name.split('_')
+    return int(x), int(y)
+
+SCHEME_COORDS = {
+    'xyz': xyz_coords,
+    'zyx': zyx_coords,
+    'ags': ags_coords,
+    'gwc': gwc_coords,
+}
+
+def walk_tiles(directory_path, image_format, **kwargs):
+    silent = kwargs.get('silent')
+    scheme = kwargs.get('scheme')
+    coords = SCHEME_COORDS.get(scheme, tms_coords)
+    for zoom_dir in get_dirs(directory_path):
+        if scheme == 'ags':
+            if not "L" in zoom_dir:
+                if not silent: 
+                    logger.warning("You appear to be using an ags scheme on an non-arcgis Server cache.")
+            z = int(zoom_dir.replace("L", ""))
+        elif scheme == 'gwc':
+            z=int(zoom_dir[-2:])
+        else:
+            if "L" in zoom_dir:
+                if not silent: 
+                    logger.warning("You appear to be using a %s scheme on an arcgis Server cache. Try using --scheme=ags instead" % scheme)
+            z = int(zoom_dir)
+        for row_dir in get_dirs(os.path.join(directory_path, zoom_dir)):
+            with os.scandir(os.path.join(directory_path, zoom_dir, row_dir)) as entries:
+                for entry in entries:
+                    current_file = entry.name
+                    if current_file == ".DS_Store":
+                        if not silent:
+                            logger.warning("Your OS is MacOS,and the .DS_Store file will be ignored.")
+                        continue
+                    file_name, ext = current_file.split('.',1)
+                    if ext != image_format and ext != 'grid.json':
+                        continue
+                    x, y = coords(z, row_dir, file_name)
+                    yield z, x, y, ext, entry.path
 
 def disk_to_mbtiles(directory_path, mbtiles_file, **kwargs):
 
@@ -178,7 +350,7 @@ def disk_to_mbtiles(directory_path, mbtiles_file, **kwargs):
     con = mbtiles_connect(mbtiles_file, silent)
     cur = con.cursor()
     optimize_connection(cur)
-    mbtiles_setup(cur)
+    mbtiles_setup_tables(cur)
     #~ image_format = 'png'
     image_format = kwargs.get('format', 'png')
 
@@ -196,77 +368,48 @@ def disk_to_mbtiles(directory_path, mbtiles_file, **kwargs):
 
     count = 0
     start_time = time.time()
-
-    for zoom_dir in get_dirs(directory_path):
-        if kwargs.get("scheme") == 'ags':
-            if not "L" in zoom_dir:
-                if not silent: 
-                    logger.warning("You appear to be using an ags scheme on an non-arcgis Server cache.")
-            z = int(zoom_dir.replace("L", ""))
-        elif kwargs.get("scheme") == 'gwc':
-            z=int(zoom_dir[-2:])
-        else:
-            if "L" in zoom_dir:
-                if not silent: 
-                    logger.warning("You appear to be using a %s scheme on an arcgis Server cache. Try using --scheme=ags instead" % kwargs.get("scheme"))
-            z = int(zoom_dir)
-        for row_dir in get_dirs(os.path.join(directory_path, zoom_dir)):
-            if kwargs.get("scheme") == 'ags':
-                y = flip_y(z, int(row_dir.replace("R", ""), 16))
-            elif kwargs.get("scheme") == 'gwc':
-                pass
-            elif kwargs.get("scheme") == 'zyx':
-                y = flip_y(int(z), int(row_dir))
-            else:
-                x = int(row_dir)
-            for current_file in os.listdir(os.path.join(directory_path, zoom_dir, row_dir)):
-                if current_file == ".DS_Store" and not silent:
-                    logger.warning("Your OS is MacOS,and the .DS_Store file will be ignored.")
+    tiles = []
+    grids = []
+    grid_data = []
+
+    on_disk = walk_tiles(directory_path, image_format, **kwargs)
+    grid_files = []
+    # the grid pool has to exist before the reader threads do
+    with (grid_pool() or contextlib.nullcontext()) as grid_executor, \
+            concurrent.futures.ThreadPoolExecutor(max_workers=READ_WORKERS) as executor:
+        # read the next batch of files while the current one is inserted
+        batch = list(itertools.islice(on_disk, BATCH_SIZE))
+        contents = executor.map(read_file, [t[4] for t in batch])
+        while batch:
+            next_batch = list(itertools.islice(on_disk, BATCH_SIZE))
+            next_contents = executor.map(read_file, [t[4] for t in next_batch])
+            for (z, x, y, ext, path), file_content in zip(batch, contents):
+                if (ext == image_format):
+                    if not silent:
+                        logger.debug(' Read tile from Zoom (z): %i\tCol (x): %i\tRow (y): %i' % (z, x, y))
+                    tiles.append((z, x, y, sqlite3.Binary(file_content)))
+                    count = count + 1
+                    if (count % 100) == 0 and not silent:
+                        logger.info(" %s tiles inserted (%d tiles/sec)" % (count, count / (time.time() - start_time)))
                 else:
-                    file_name, ext = current_file.split('.',1)
-                    f = open(os.path.join(directory_path, zoom_dir, row_dir, current_file), 'rb')
-                    file_content = f.read()
-                    f.close()
-                    if kwargs.get('scheme') == 'xyz':
-                        y = flip_y(int(z), int(file_name))
-                    elif kwargs.get("scheme") == 'ags':
-                        x = int(file_name.replace("C", ""), 16)
-                    elif kwargs.get("scheme") == 'gwc':
-                        x, y = file_name.split('_')
-                        x = int(x)
-                        y = int(y)
-                    elif kwargs.get("scheme") == 'zyx':
-                        x = int(file_name)
-                    else:
-                        y = int(file_name)
-
-                    if (ext == image_format):
-                        if not silent:
-                            logger.debug(' Read tile from Zoom (z): %i\tCol (x): %i\tRow (y): %i' % (z, x, y))
-                        cur.execute("""insert into tiles (zoom_level,
-                            tile_column, tile_row, tile_data) values
-                            (?, ?, ?, ?);""",
-                            (z, x, y, sqlite3.Binary(file_content)))
-                        count = count + 1
-                        if (count % 100) == 0 and not silent:
-                            logger.info(" %s tiles inserted (%d tiles/sec)" % (count, count / (time.time() - start_time)))
-                    elif (ext == 'grid.json'):
-                        if not silent:
-                            logger.debug(' Read grid from Zoom (z): %i\tCol (x): %i\tRow (y): %i' % (z, x, y))
-                        # Remove potential callback with regex
-                        file_content = file_content.decode('utf-8')
-                        has_callback = re.match(r'[\w\s=+-/]+\(({(.|\n)*})\);?', file_content)
-                        if has_callback:
-                            file_content = has_callback.group(1)
-                        utfgrid = json.loads(file_content)
-
-                        data = utfgrid.pop('data')
-                        compressed = zlib.compress(json.dumps(utfgrid).encode())
-                        cur.execute("""insert into grids (zoom_level, tile_column, tile_row, grid) values (?, ?, ?, ?) """, (z, x, y, sqlite3.Binary(compressed)))
-                        grid_keys = [k for k in utfgrid['keys'] if k != ""]
-                        for key_name in grid_keys:
-                            key_json = data[key_name]
-                            cur.execute("""insert into grid_data (zoom_level, tile_column, tile_row, key_name, key_json) values (?, ?, ?, ?, ?);""", (z, x, y, key_name, json.dumps(key_json)))
+                    if not silent:
+                        logger.debug(' Read grid from Zoom (z): %i\tCol (x): %i\tRow (y): %i' % (z, x, y))
+                    grid_files.append((z, x, y, file_content))
+            if grid_executor is not None:
+                encoded = grid_executor.map(encode_grid, [g[3] for g in grid_files], chunksize=16)
+            else:
+                encoded = map(encode_grid, [g[3] for g in grid_files])
+            for (z, x, y, file_content), (compressed, keys) in zip(grid_files, encoded):
+                grids.append((z, x, y, sqlite3.Binary(compressed)))
+                for key_name, key_json in keys:
+                    grid_data.append((z, x, y, key_name, key_json))
+            del grid_files[:]
+            insert_batch(cur, tiles, grids, grid_data)
+            batch = next_batch
+            contents = next_contents
+
+    mbtiles_setup_indexes(cur)
+    con.commit()
 
     if not silent:
         logger.debug('tiles (and grids) inserted.')
@@ -277,6 +420,7 @@ def disk_to_mbtiles(directory_path, mbtiles_file, **kwargs):
         compression_finalize(cur, con, silent)
 
     optimize_database(con, silent)
+    optimize_connection(cur, bulk=False)
 
 def mbtiles_metadata_to_disk(mbtiles_file, **kwargs):
     silent = kwargs.get('silent')
@@ -287,8 +431,26 @@ def mbtiles_metadata_to_disk(mbtiles_file, **kwargs):
     if not silent:
         logger.debug(json.dumps(metadata, indent=2))
 
+# MapServer WMS TileCache layout, z/000/000/x/000/000/y.ext
+WMS_PATH = os.path.join('{z:02d}', '{a:03d}', '{b:03d}', '{c:03d}',
+    '{d:03d}', '{e:03d}', '{f:03d}.{ext}').format
+
+def wms_path(z, x, y, ext):
+    return WMS_PATH(z=z, a=x // 1000000, b=(x // 1000) % 1000, c=x % 1000,
+        d=y // 1000000, e=(y // 1000) % 1000, f=y % 1000, ext=ext)
+
+def fetch_rows(cursor):
+    while True:
+        rows = cursor.fetchmany(FETCH_SIZE)
+        if not rows:
+            break
+        for row in rows:
+            yield row
+
 def mbtiles_to_disk(mbtiles_file, directory_path, **kwargs):
     silent = kwargs.get('silent')
+    scheme = kwargs.get('scheme')
+    image_format = kwargs.get('format', 'png')
     if not silent:
         logger.debug("Exporting MBTiles to disk")
         logger.debug("%s --> %s" % (mbtiles_file, directory_path))
@@ -309,143 +471,180 @@ def mbtiles_to_disk(mbtiles_file, directory_path, **kwargs):
         formatter_json = {"formatter":formatter}
         open(layer_json, 'w').write(json.dumps(formatter_json))
 
-    tiles = con.execute('select zoom_level, tile_column, tile_row, tile_data from tiles;')
-    t = tiles.fetchone()
-    while t:
+    # directories already created, so each one is only made once
+    made_dirs = set()
+    # stream tile_data straight from the database file when sqlite3 supports
+    # incremental blob I/O (python>=3.11) and tiles is a table, not a view
+    tiles_type = con.execute("""select type from sqlite_master
+        where name = 'tiles';""").fetchone()
+    stream = hasattr(con, 'blobopen') and tiles_type is not None and tiles_type[0] == 'table'
+    if stream:
+        tiles = con.execute('select zoom_level, tile_column, tile_row, rowid from tiles;')
+    else:
+        tiles = con.execute('select zoom_level, tile_column, tile_row, tile_data from tiles;')
+    for t in fetch_rows(tiles):
         z = t[0]
         x = t[1]
         y = t[2]
-        if kwargs.get('scheme') == 'xyz':
+        if scheme == 'xyz':
             y = flip_y(z,y)
             if not silent:
                 logger.debug('flipping')
-            tile_dir = os.path.join(base_path, str(z), str(x))
-        elif kwargs.get('scheme') == 'wms':
-            tile_dir = os.path.join(base_path,
-                "%02d" % (z),
-                "%03d" % (int(x) / 1000000),
-                "%03d" % ((int(x) / 1000) % 1000),
-                "%03d" % (int(x) % 1000),
-                "%03d" % (int(y) / 1000000),
-                "%03d" % ((int(y) / 1000) % 1000))
+        if scheme == 'wms':
+            tile = os.path.join(base_path, wms_path(z, x, y, image_format))
+            tile_dir = os.path.dirname(tile)
         else:
             tile_dir = os.path.join(base_path, str(z), str(x))
-        if not os.path.isdir(tile_dir):
-            os.makedirs(tile_dir)
-        if kwargs.get('scheme') == 'wms':
-            tile = os.path.join(tile_dir,'%03d.%s' % (int(y) % 1000, kwargs.get('format', 'png')))
-        else:
-            tile = os.path.join(tile_dir,'%s.%s' % (y, kwargs.get('format', 'png')))
+            tile = os.path.join(tile_dir,'%s.%s' % (y, image_format))
+        if tile_dir not in made_dirs:
+            os.makedirs(tile_dir, exist_ok=True)
+            made_dirs.add(tile_dir)
         f = open(tile, 'wb')
-        f.write(t[3])
+        if stream:
+            with con.blobopen('tiles', 'tile_data', t[3], readonly=True) as blob:
+                shutil.copyfileobj(blob, f, BLOB_CHUNK_SIZE)
+        else:
+            f.write(t[3])
         f.close()
         done = done + 1
         if not silent:
             logger.info('%s / %s tiles exported' % (done, count))
-        t = tiles.fetchone()
 
     # grids
     callback = kwargs.get('callback')
     done = 0
     try:
         count = con.execute('select count(zoom_level) from grids;').fetchone()[0]
-        grids = con.execute('select zoom_level, tile_column, tile_row, grid from grids;')
-        g = grids.fetchone()
+        # both sides sorted the same way, so they can be merge-joined
+        grids = con.execute('''select zoom_level, tile_column, tile_row, grid
+            from grids order by zoom_level, tile_column, tile_row;''')
+        grid_data = itertools.groupby(fetch_rows(con.execute('''select zoom_level,
+            tile_column, tile_row, key_name, key_json from grid_data
+            order by zoom_level, tile_column, tile_row;''')), lambda r: r[:3])
+        group = next(grid_data, None)
     except sqlite3.OperationalError:
-        g = None # no grids table
-    while g:
-        zoom_level = g[0] # z
-        tile_column = g[1] # x
-        y = g[2] # y
-        grid_data_cursor = con.execute('''select key_name, key_json FROM
-            grid_data WHERE
-            zoom_level = %(zoom_level)d and
-            tile_column = %(tile_column)d and
-            tile_row = %(y)d;''' % locals() )
-        if kwargs.get('scheme') == 'xyz':
-            y = flip_y(zoom_level,y)
-        grid_dir = os.path.join(base_path, str(zoom_level), str(tile_column))
-        if not os.path.isdir(grid_dir):
-            os.makedirs(grid_dir)
-        grid = os.path.join(grid_dir,'%s.grid.json' % (y))
-        f = open(grid, 'w')
-        grid_json = json.loads(zlib.decompress(g[3]).decode('utf-8'))
-        # join up with the grid 'data' which is in pieces when stored in mbtiles file
-        grid_data = grid_data_cursor.fetchone()
-        data = {}
-        while grid_data:
-            data[grid_data[0]] = json.loads(grid_data[1])
-            grid_data = grid_data_cursor.fetchone()
-        grid_json['data'] = data
-        if callback in (None, "", "false", "null"):
-            f.write(json.dumps(grid_json))
-        else:
-            f.write('%s(%s);' % (callback, json.dumps(grid_json)))
-        f.close()
-        done = done + 1
-        if not silent:
-            logger.info('%s / %s grids exported' % (done, count))
-        g = grids.fetchone()
+        grids = None # no grids table
+    if grids is not None:
+        for g in fetch_rows(grids):
+            zoom_level = g[0] # z
+            tile_column = g[1] # x
+            y = g[2] # y
+            if scheme == 'xyz':
+                y = flip_y(zoom_level,y)
+            grid_dir = os.path.join(base_path, str(zoom_level), str(tile_column))
+            if grid_dir not in made_dirs:
+                os.makedirs(grid_dir, exist_ok=True)
+                made_dirs.add(grid_dir)
+            grid = os.path.join(grid_dir,'%s.grid.json' % (y))
+            f = open(grid, 'wb')
+            # join up with the grid 'data' which is in pieces when stored in mbtiles file
+            while group is not None and group[0] < g[:3]:
+                group = next(grid_data, None)
+            data = []
+            if group is not None and group[0] == g[:3]:
+                data = [(r[3], r[4]) for r in group[1]]
+                group = next(grid_data, None)
+            grid_bytes = grid_dumps(g[3], data)
+            if callback in (None, "", "false", "null"):
+                f.write(grid_bytes)
+            else:
+                f.write(b'%s(%s);' % (callback.encode('utf-8'), grid_bytes))
+            f.close()
+            done = done + 1
+            if not silent:
+                logger.info('%s / %s grids exported' % (done, count))
 
 MAX_WORKERS = 275
-http = urllib3.PoolManager(num_pools=MAX_WORKERS, maxsize=MAX_WORKERS, block=True)
-executing = 0
-done = 0
-sem = threading.Semaphore(MAX_WORKERS)
 upload_urls = []
 
-def get_upload_url(url, **kwargs):
+async def get_upload_url(session, url, **kwargs):
     s = 1
     while True:
-        resp = http.request("GET", url, headers={ "Authorization": kwargs["access_key"] })
-        if resp.status == 200:
-            j = json.loads(resp.data)
-            logger.info(f'added worker {j["uploadUrl"]} {j["authorizationToken"]}')
-            return j
-        elif resp.status == 429:
-            time.sleep(resp.headers.get('Retry-After', s))
-            s = 1
-        elif resp.status == 503:
-            time.sleep(s)
-            s *= 2
-        else:
-            raise Exception('could not access url: ' + resp.data.decode())
-
-# grep '\(Success\|Skip\)' nohup.out | sed 's/INFO:mbutil.util:\(Success\|Skip\): //' > success_urls.txt
-# grep Fail nohup.out | sed 's/INFO:mbutil.util:Failure: //' > failure_urls.txt
-try:
-    processed = set(line.strip() for line in open('success_urls.txt'))
-except:
-    processed = set()
-try:
-    failures = set(line.strip() for line in open('failure_urls.txt'))
-    use_failures = True
-except:
-    failures = set()
-    use_failures = False
-
-def upload_file(data, url, key, **kwargs):
-    if use_failures:
-        if not key in failures:
-            logger.info(f"Skip: {key}")
-            return
-    elif key in processed:
+        async with session.get(url, headers={ "Authorization": kwargs["access_key"] }) as resp:
+            if resp.status == 200:
+                j = json.loads(await resp.read())
+                logger.info(f'added worker {j["uploadUrl"]} {j["authorizationToken"]}')
+                return j
+            elif resp.status == 429:
+                await asyncio.sleep(float(resp.headers.get('Retry-After', s)))
+                s = 1
+            elif resp.status == 503:
+                await asyncio.sleep(s)
+                s *= 2
+            else:
+                raise Exception('could not access url: ' + (await resp.read()).decode())
+
+# resume files of older versions, read from the working directory once,
+# when the upload_state table is created
+LEGACY_UPLOAD_STATE = (('failure_urls.txt', 0), ('success_urls.txt', 1))
+
+class UploadState(object):
+    """Records the outcome of every upload in an upload_state table, so a
+    later run skips what succeeded and retries failed or untried keys."""
+
+    def __init__(self, db_file):
+        self.pending = []
+        self.con = sqlite3.connect(db_file)
+        # WAL lets the tiles be read while the state is written
+        self.con.execute("""PRAGMA journal_mode=WAL""")
+        exists = self.con.execute("""select 1 from sqlite_master
+            where name = 'upload_state';""").fetchone()
+        self.con.execute("""CREATE TABLE IF NOT EXISTS upload_state
+            (key TEXT PRIMARY KEY, status INTEGER);""")
+        if not exists:
+            self.import_legacy()
+        self.con.commit()
+
+    def import_legacy(self):
+        for path, status in LEGACY_UPLOAD_STATE:
+            try:
+                f = open(path, 'r')
+            except IOError:
+                continue
+            with f:
+                self.pending.extend((line.strip(), status) for line in f if line.strip())
+            logger.info('upload state imported from %s' % path)
+        self.flush()
+
+    def skip(self, key):
+        row = self.con.execute("""select status from upload_state
+            where key = ? limit 1;""", (key,)).fetchone()
+        return row is not None and row[0] == 1
+
+    def record(self, key, success):
+        self.pending.append((key, 1 if success else 0))
+
+    def flush(self):
+        self.con.executemany("""insert or replace into upload_state
+            (key, status) values (?, ?);""", self.pending)
+        self.con.commit()
+        self.pending = []
+
+    def close(self):
+        self.flush()
+        # leave the file in the journal mode it is normally used with
+        self.con.execute("""PRAGMA journal_mode=DELETE""")
+        self.con.close()
+
+upload_state = None
+
+async def upload_file(session, data, url, key, **kwargs):
+    if upload_state and upload_state.skip(key):
         logger.info(f"Skip: {key}")
         return
+    sha1hex = sha1(data).hexdigest()
     for attempt in range(0,5):
         try:
-            sha1hex = sha1(data).hexdigest()
-
             if len(upload_urls) > 0:
                 uploadurl = upload_urls.pop()
             else:
-                uploadurl = get_upload_url(url, **kwargs)
+                uploadurl = await get_upload_url(session, url, **kwargs)
             headers = {
                 # b2 secific
                 "Authorization": uploadurl['authorizationToken'],
                 "X-Bz-File-Name": key,
                 "Content-Type": "application/x-protobuf",
-                "Content-Length": len(data),
+                "Content-Length": str(len(data)),
                 "X-Bz-Info-b2-content-encoding": "gzip",
                 "X-Bz-Content-Sha1": sha1hex,
                 "X-Bz-Info-b2-cache-control": "public%2Cimmutable%2Cmax-age=31536000", # 365 days
@@ -455,20 +654,24 @@ def upload_file(data, url, key, **kwargs):
                 # "Content-Type": "application/octet-stream",
                 # "accept": "application/json"
             }
-            resp1 = http.request("POST", uploadurl['uploadUrl'], headers=headers, body=data)    
-            if resp1.status != 401:
-                upload_urls.append(uploadurl)
-            if resp1.status == 200:
-                logger.info(f"Success: {key}")
-                return
-            if resp1.status == 408 or resp1.status == 429:
-                time.sleep(2)
-            logger.error(f"Attempt {attempt+1} failure: {key}: {resp1.data.decode()}")
+            async with session.post(uploadurl['uploadUrl'], headers=headers, data=data) as resp1:
+                if resp1.status != 401:
+                    upload_urls.append(uploadurl)
+                if resp1.status == 200:
+                    logger.info(f"Success: {key}")
+                    if upload_state:
+                        upload_state.record(key, True)
+                    return
+                if resp1.status == 408 or resp1.status == 429:
+                    await asyncio.sleep(2)
+                logger.error(f"Attempt {attempt+1} failure: {key}: {(await resp1.read()).decode()}")
         except Exception as e:
             logger.error(f"Attempt {attempt+1} exception uploading file {key}: {e}")
     logger.error(f"Failure: {key}")
+    if upload_state:
+        upload_state.record(key, False)
 
-def upload_tile(t, url, **kwargs):
+async def upload_tile(session, t, url, **kwargs):
     silent = kwargs.get('silent')
     prefix = kwargs.get('prefix')
     z = t[0]
@@ -478,26 +681,42 @@ def upload_tile(t, url, **kwargs):
         y = flip_y(z,y)
         if not silent:
             logger.debug('flipping')
-        tile_dir = os.path.join(prefix, str(z), str(x))
-    elif kwargs.get('scheme') == 'wms':
-        tile_dir = os.path.join(prefix,
-            "%02d" % (z),
-            "%03d" % (int(x) / 1000000),
-            "%03d" % ((int(x) / 1000) % 1000),
-            "%03d" % (int(x) % 1000),
-            "%03d" % (int(y) / 1000000),
-            "%03d" % ((int(y) / 1000) % 1000))
-    else:
-        tile_dir = os.path.join(prefix, str(z), str(x))
     if kwargs.get('scheme') == 'wms':
-        tile = os.path.join(tile_dir,'%03d.%s' % (int(y) % 1000, kwargs.get('format', 'png')))
+        tile = os.path.join(prefix, wms_path(z, x, y, kwargs.get('format', 'png')))
     else:
-        tile = os.path.join(tile_dir,'%s.%s' % (y, kwargs.get('format', 'png')))
-    upload_file(t[3], url, tile, **kwargs)
+        tile = os.path.join(prefix, str(z), str(x), '%s.%s' % (y, kwargs.get('format', 'png')))
+    await upload_file(session, t[3], url, tile, **kwargs)
+
+async def upload_tiles(session, tiles, count, url, **kwargs):
+    silent = kwargs.get('silent')
+    queue = asyncio.Queue(MAX_WORKERS)
+    done = itertools.count(1)
+
+    # MAX_WORKERS uploaders drain the queue until they receive None
+    async def worker():
+        while True:
+            t = await queue.get()
+            if t is None:
+                return
+            await upload_tile(session, t, url, **kwargs)
+            n = next(done)
+            if not silent:
+                logger.info('%s / %s tiles exported' % (n, count))
+
+    workers = [asyncio.ensure_future(worker()) for i in range(MAX_WORKERS)]
+    submitted = 0
+    for t in tiles:
+        await queue.put(t)
+        submitted += 1
+        if submitted % BATCH_SIZE == 0:
+            upload_state.flush()
+    for w in workers:
+        await queue.put(None)
+    await asyncio.gather(*workers)
+    upload_state.flush()
 
 def mbtiles_to_url(mbtiles_file, url, **kwargs):
-    global done
-    global executing
+    global upload_state
 
     maxzoom = kwargs.get('maxzoom')
     prefix = kwargs.get('prefix')
@@ -506,55 +725,42 @@ def mbtiles_to_url(mbtiles_file, url, **kwargs):
         logger.debug("Exporting MBTiles to url")
         logger.debug("%s --> %s" % (mbtiles_file, url))
     
+    upload_state = UploadState(mbtiles_file)
     con = mbtiles_connect(mbtiles_file, silent)
     metadata = dict(con.execute('select name, value from metadata;').fetchall())
-    upload_file(json.dumps(metadata, indent=4).encode(), url, os.path.join(prefix, 'metadata.json'), **kwargs)
     count = con.execute(f'select count(zoom_level) from tiles where zoom_level <= {maxzoom};').fetchone()[0]
-
-    # if interactivity
-    formatter = metadata.get('formatter')
-    if formatter:
-        formatter_json = {"formatter":formatter}
-        upload_file(json.dumps(formatter_json), url, os.path.join(prefix, 'layer.json'), **kwargs)    
     tiles = con.execute(f'select zoom_level, tile_column, tile_row, tile_data from tiles where zoom_level <= {maxzoom};')
-    
-    done = 0
-    executing = 0
-    def doneCb(r):
-        global done
-        global executing
-        global sem
-        executing -= 1
-        done = done + 1
-        sem.release()
-        if not silent:
-            logger.info('%s / %s tiles exported (executing %s)' % (done, count, executing))
-
-    with concurrent.futures.ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
-        t = tiles.fetchone()
-        while t:
-            sem.acquire()
-            future = executor.submit(upload_tile, t, url, **kwargs)
-            executing += 1
-            if not silent:
-                logger.debug('%s tiles executing' % (executing))
-            future.add_done_callback(doneCb)
-            t = tiles.fetchone()
 
-    # grids
-    done = 0
+    async def run():
+        connector = aiohttp.TCPConnector(limit=MAX_WORKERS)
+        async with aiohttp.ClientSession(connector=connector) as session:
+            await upload_file(session, json.dumps(metadata, indent=4).encode(), url, os.path.join(prefix, 'metadata.json'), **kwargs)
+            # if interactivity
+            formatter = metadata.get('formatter')
+            if formatter:
+                formatter_json = {"formatter":formatter}
+                await upload_file(session, json.dumps(formatter_json).encode(), url, os.path.join(prefix, 'layer.json'), **kwargs)
+            await upload_tiles(session, fetch_rows(tiles), count, url, **kwargs)
+
     try:
-        count = con.execute('select count(zoom_level) from grids;').fetchone()[0]
-        grids = con.execute('select zoom_level, tile_column, tile_row, grid from grids;')
-        g = grids.fetchone()
-    except sqlite3.OperationalError:
-        g = None # no grids table
-    while g:
-        raise Exception('grids are not supported')
+        asyncio.run(run())
+
+        # grids
+        try:
+            count = con.execute('select count(zoom_level) from grids;').fetchone()[0]
+            grids = con.execute('select zoom_level, tile_column, tile_row, grid from grids;')
+            g = grids.fetchone()
+        except sqlite3.OperationalError:
+            g = None # no grids table
+        while g:
+            raise Exception('grids are not supported')
+    finally:
+        # the reader must be gone before the journal mode can be switched back
+        con.close()
+        upload_state.close()
 
 def pmtiles_to_url(pmtiles_file, url, **kwargs):
-    global done
-    global executing
+    global upload_state
 
     maxzoom = kwargs.get('maxzoom')
     prefix = kwargs.get('prefix')
@@ -563,37 +769,27 @@ def pmtiles_to_url(pmtiles_file, url, **kwargs):
         logger.debug("Exporting PMTiles to url")
         logger.debug("%s --> %s" % (pmtiles_file, url))
     
+    upload_state = UploadState('%s.upload_state' % pmtiles_file)
     with open(pmtiles_file) as f:
         source = MmapSource(f)
         reader = Reader(source)
         metadata = reader.metadata()
-        upload_file(json.dumps(metadata, indent=4).encode(), url, os.path.join(prefix, 'metadata.json'), **kwargs)
         count = reader.header()['addressed_tiles_count']
 
-        done = 0
-        executing = 0
-        def doneCb(r):
-            global done
-            global executing
-            global sem
-            executing -= 1
-            done = done + 1
-            sem.release()
-            if not silent:
-                logger.info('%s / %s tiles exported (executing %s)' % (done, count, executing))
-
-        tiles = all_tiles(source)
-        with concurrent.futures.ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
-            t = next(tiles, None)
-            while t:
-                sem.acquire()
-                zxy = t[0]
+        def flipped(tiles):
+            for zxy, data in tiles:
                 z = zxy[0]
                 x = zxy[1]
                 flipped_y = (1 << z) - 1 - zxy[2]
-                future = executor.submit(upload_tile, [z, x, flipped_y, t[1]], url, **kwargs)
-                executing += 1
-                if not silent:
-                    logger.debug('%s tiles executing' % (executing))
-                future.add_done_callback(doneCb)
-                t = next(tiles, None)
+                yield [z, x, flipped_y, data]
+
+        async def run():
+            connector = aiohttp.TCPConnector(limit=MAX_WORKERS)
+            async with aiohttp.ClientSession(connector=connector) as session:
+                await upload_file(session, json.dumps(metadata, indent=4).encode(), url, os.path.join(prefix, 'metadata.json'), **kwargs)
+                await upload_tiles(session, flipped(all_tiles(source)), count, url, **kwargs)
+
+        try:
+            asyncio.run(run())
+        finally:
+            upload_state.close()
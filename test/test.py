@@ -1,13 +1,28 @@
-import os, shutil
+import os, shutil, sqlite3, subprocess
 import sys
+import math
 import json
 from nose import with_setup
-from mbutil import mbtiles_to_disk, disk_to_mbtiles
+from mbutil import mbtiles_to_disk, disk_to_mbtiles, mbtiles_setup, UploadState, BLOB_CHUNK_SIZE
 
 def clear_data():
     try: shutil.rmtree('test/output')
     except Exception: pass
 
+def make_grid_mbtiles(path, grids):
+    # the utf8grid fixture grid at each (z, x, y), with its own grid_data
+    src = sqlite3.connect('test/data/utf8grid.mbtiles')
+    grid = src.execute('select grid from grids').fetchone()[0]
+    src.close()
+    con = sqlite3.connect(path)
+    mbtiles_setup(con.cursor())
+    for (z, x, y), data in grids:
+        con.execute('insert into grids values (?, ?, ?, ?)', (z, x, y, grid))
+        con.executemany('insert into grid_data values (?, ?, ?, ?, ?)',
+            [(z, x, y, k, json.dumps(v)) for k, v in data.items()])
+    con.commit()
+    con.close()
+
 @with_setup(clear_data, clear_data)
 def test_mbtiles_to_disk():
     mbtiles_to_disk('test/data/one_tile.mbtiles', 'test/output')
@@ -57,3 +72,162 @@ def test_disk_to_mbtiles_zyx():
     disk_to_mbtiles('test/data/tiles/zyx', 'test/output/zyx.mbtiles', scheme='zyx', format='png')
     mbtiles_to_disk('test/output/zyx.mbtiles', 'test/output/tiles', callback=None)
     assert os.path.exists('test/output/tiles/3/1/5.png')
+
+@with_setup(clear_data, clear_data)
+def test_mbtiles_to_disk_wms():
+    os.makedirs('test/output/tms/22/1234567')
+    shutil.copy('test/data/tiles/zyx/3/2/1.png', 'test/output/tms/22/1234567/3654321.png')
+    disk_to_mbtiles('test/output/tms', 'test/output/tms.mbtiles', scheme='tms', format='png')
+    mbtiles_to_disk('test/output/tms.mbtiles', 'test/output/wms', scheme='wms')
+    assert os.path.exists('test/output/wms/22/001/234/567/003/654/321.png')
+
+@with_setup(clear_data, clear_data)
+def test_upload_state_resume():
+    os.mkdir('test/output')
+    shutil.copy('test/data/one_tile.mbtiles', 'test/output/one.mbtiles')
+    state = UploadState('test/output/one.mbtiles')
+    state.record('done.png', True)
+    state.record('failed.png', False)
+    state.close()
+    state = UploadState('test/output/one.mbtiles')
+    assert state.skip('done.png')
+    assert not state.skip('failed.png')
+    assert not state.skip('untried.png')
+    state.record('failed.png', True)
+    state.close()
+    state = UploadState('test/output/one.mbtiles')
+    assert state.skip('failed.png')
+    state.close()
+    con = sqlite3.connect('test/output/one.mbtiles')
+    assert con.execute('PRAGMA journal_mode').fetchone()[0] == 'delete'
+    con.close()
+    assert not os.path.exists('test/output/one.mbtiles-wal')
+
+@with_setup(clear_data, clear_data)
+def test_upload_state_legacy_files():
+    os.mkdir('test/output')
+    shutil.copy('test/data/one_tile.mbtiles', 'test/output/one.mbtiles')
+    cwd = os.getcwd()
+    os.chdir('test/output')
+    try:
+        open('success_urls.txt', 'w').write('done.png\nretried.png\n')
+        open('failure_urls.txt', 'w').write('failed.png\nretried.png\n')
+        state = UploadState('one.mbtiles')
+        assert state.skip('done.png')
+        assert state.skip('retried.png')
+        assert not state.skip('failed.png')
+        state.record('failed.png', True)
+        state.close()
+        # imported once, later runs keep their own state
+        state = UploadState('one.mbtiles')
+        assert state.skip('failed.png')
+        state.close()
+    finally:
+        os.chdir(cwd)
+
+@with_setup(clear_data, clear_data)
+def test_mbtiles_to_disk_utfgrid_unicode():
+    os.mkdir('test/output')
+    make_grid_mbtiles('test/output/grid.mbtiles', [((0, 0, 0), {'1': {'name': u'東京'}})])
+    mbtiles_to_disk('test/output/grid.mbtiles', 'test/output/tiles', callback='grid')
+    f = open('test/output/tiles/0/0/0.grid.json', 'rb')
+    content = f.read().decode('utf-8')
+    f.close()
+    assert content.startswith('grid(') and content.endswith(');')
+    grid = json.loads(content[len('grid('):-len(');')])
+    assert grid['data'] == {'1': {'name': u'東京'}}
+
+@with_setup(clear_data, clear_data)
+def test_mbtiles_to_disk_utfgrid_nan():
+    os.mkdir('test/output')
+    make_grid_mbtiles('test/output/grid.mbtiles',
+        [((0, 0, 0), {'1': {'area': float('nan'), 'id': 2 ** 70}})])
+    mbtiles_to_disk('test/output/grid.mbtiles', 'test/output/tiles', callback=None)
+    grid = json.load(open('test/output/tiles/0/0/0.grid.json'))
+    assert math.isnan(grid['data']['1']['area'])
+    assert grid['data']['1']['id'] == 2 ** 70
+
+@with_setup(clear_data, clear_data)
+def test_disk_to_mbtiles_compression():
+    tiles = {}
+    for z in range(4):
+        for x in range(2 ** z):
+            os.makedirs('test/output/tiles/%d/%d' % (z, x))
+            for y in range(2 ** z):
+                tile = '%d/%d/%d.png' % (z, x, y)
+                tiles[tile] = b'tile %d' % ((x + y) % 5)
+                f = open('test/output/tiles/' + tile, 'wb')
+                f.write(tiles[tile])
+                f.close()
+    disk_to_mbtiles('test/output/tiles', 'test/output/compressed.mbtiles',
+        scheme='tms', format='png', compression=True)
+    con = sqlite3.connect('test/output/compressed.mbtiles')
+    assert con.execute('select count(*) from map').fetchone()[0] == 85
+    assert con.execute('select count(*) from images').fetchone()[0] == 5
+    assert con.execute("select type from sqlite_master where name = 'tiles'").fetchone()[0] == 'view'
+    con.close()
+    mbtiles_to_disk('test/output/compressed.mbtiles', 'test/output/exported', scheme='tms')
+    for tile, content in tiles.items():
+        f = open('test/output/exported/' + tile, 'rb')
+        assert f.read() == content
+        f.close()
+
+@with_setup(clear_data, clear_data)
+def test_mbtiles_to_disk_streamed_tiles():
+    # tiles as a real table are streamed in BLOB_CHUNK_SIZE pieces
+    os.mkdir('test/output')
+    tiles = {
+        (0, 0, 0): os.urandom(BLOB_CHUNK_SIZE * 3 + 17),
+        (1, 1, 0): os.urandom(BLOB_CHUNK_SIZE),
+        (1, 0, 1): b'small',
+    }
+    con = sqlite3.connect('test/output/tiles.mbtiles')
+    mbtiles_setup(con.cursor())
+    con.executemany('insert into tiles values (?, ?, ?, ?)',
+        [(z, x, y, data) for (z, x, y), data in tiles.items()])
+    con.commit()
+    con.close()
+    mbtiles_to_disk('test/output/tiles.mbtiles', 'test/output/tiles', scheme='tms')
+    for (z, x, y), data in tiles.items():
+        f = open('test/output/tiles/%d/%d/%d.png' % (z, x, y), 'rb')
+        assert f.read() == data
+        f.close()
+
+@with_setup(clear_data, clear_data)
+def test_mbtiles_to_disk_utfgrid_merge():
+    os.mkdir('test/output')
+    grids = [
+        ((2, 3, 1), {'1': {'ISO_A2': 'AF'}, '2': {'ISO_A2': 'AO'}}),
+        ((1, 0, 1), {'3': {'ISO_A2': 'AR'}}),
+        ((2, 0, 3), {}),
+        ((1, 1, 0), {'4': {'ISO_A2': 'AQ'}, '5': {'ISO_A2': 'TF'}}),
+        ((0, 0, 0), {'6': {'ISO_A2': 'AU'}}),
+    ]
+    make_grid_mbtiles('test/output/grid.mbtiles', grids)
+    # grid_data without a grid has to be stepped over
+    con = sqlite3.connect('test/output/grid.mbtiles')
+    con.execute("insert into grid_data values (1, 0, 0, '7', '{}')")
+    con.commit()
+    con.close()
+    mbtiles_to_disk('test/output/grid.mbtiles', 'test/output/tiles', callback=None)
+    for (z, x, y), data in grids:
+        grid = json.load(open('test/output/tiles/%d/%d/%d.grid.json' % (z, x, y)))
+        assert grid['data'] == data
+
+@with_setup(clear_data, clear_data)
+def test_utf8grid_disk_to_mbtiles_unguarded_script():
+    # grid workers must not re-run a caller that has no __main__ guard
+    os.mkdir('test/output')
+    script = '\n'.join([
+        'from mbutil import mbtiles_to_disk, disk_to_mbtiles',
+        "mbtiles_to_disk('test/data/utf8grid.mbtiles', 'test/output/original', callback=None)",
+        "disk_to_mbtiles('test/output/original', 'test/output/imported.mbtiles', format='png')",
+    ])
+    f = open('test/output/unguarded.py', 'w')
+    f.write(script)
+    f.close()
+    env = dict(os.environ, PYTHONPATH=os.getcwd())
+    subprocess.check_call([sys.executable, 'test/output/unguarded.py'], env=env)
+    con = sqlite3.connect('test/output/imported.mbtiles')
+    assert con.execute('select count(*) from grids').fetchone()[0] == 1
+    con.close()